@@ -21,19 +21,25 @@ ar -x liblustreapi.a
 gcc -shared -o liblustreapi.so *.o
 
 """
+import array
+import concurrent.futures
 import ctypes
 import ctypes.util
+import errno
+import importlib.metadata
+import logging
 import os
-import select
+import threading
 
-
-import pkg_resources
 try:
-    __version__ = pkg_resources.require("pcp")[0].version
-except pkg_resources.DistributionNotFound:
+    __version__ = importlib.metadata.version("pcp")
+except importlib.metadata.PackageNotFoundError:
     __version__ = "UNRELEASED"
 
+logger = logging.getLogger(__name__)
+
 LUSTREMAGIC = 0xbd00bd0
+LOV_MAGIC_V1 = 0x0bd10bd0
 HSM_FLAGS = [
     ('NONE', "0x00000000"),
     ('EXISTS', "0x00000001"),
@@ -44,6 +50,7 @@ HSM_FLAGS = [
     ('NOARCHIVE', "0x00000020"),
     ('LOST', "0x00000040"),
 ]
+HSM_FLAG_MAP = {name: int(value, 16) for name, value in HSM_FLAGS}
 
 liblocation = ctypes.util.find_library("lustreapi")
 # See if liblustreapi.so is in the same directory as the module
@@ -77,6 +84,29 @@ class lov_user_md_v1(ctypes.Structure):
         ]
 
 
+_lov_user_md_v1_types = {}
+
+
+def _lov_user_md_v1_sized(count):
+    """Returns a lov_user_md_v1 layout with room for only count OST objects.
+
+    llapi_file_get_stripe() takes no buffer length, so the call itself still
+    needs the full lov_user_md_v1, but the result can be kept in a structure
+    sized to the file's actual stripe count.
+    """
+    try:
+        return _lov_user_md_v1_types[count]
+    except KeyError:
+        pass
+
+    class lov_user_md_v1_n(ctypes.Structure):
+        _fields_ = lov_user_md_v1._fields_[:-1] + [
+            ("lmm_objects", lov_user_ost_data_v1 * count),
+            ]
+    _lov_user_md_v1_types[count] = lov_user_md_v1_n
+    return lov_user_md_v1_n
+
+
 class hsm_user_state(ctypes.Structure):
     _fields_ = [
         ("hus_states", ctypes.c_uint),
@@ -93,27 +123,38 @@ class lu_fid(ctypes.Structure):
 
 
 class Fid:
+    __slots__ = ('seq', 'oid', 'ver', '_s')
+
     def __init__(self, seq, oid, ver):
         self.seq = int(seq)
         self.oid = int(oid)
         self.ver = int(ver)
+        self._s = None
 
     def __str__(self):
-        string = "[0x%x:0x%x:0x%x]" \
-                 % (self.seq, self.oid, self.ver)
-        return(string)
+        # Rendered once, FIDs are printed repeatedly when walking changelogs.
+        # The cache is keyed on the fields so assigning them still works.
+        key = (self.seq, self.oid, self.ver)
+        cached = self._s
+        if cached is None or cached[0] != key:
+            seq, oid, ver = key
+            cached = (key, f"[0x{seq:x}:0x{oid:x}:0x{ver:x}]")
+            self._s = cached
+        return(cached[1])
 
 
 class HSM_state:
     """
     """
+    __slots__ = ('archive_id', 'states')
+
     def __init__(self, hus):
         self.archive_id = int(hus.hus_archive_id)
         self.states = []
         state = int(hus.hus_states)
-        for flag in HSM_FLAGS:
-            if state & int(flag[1], 16):
-                self.states.append(flag[0])
+        for name, value in HSM_FLAG_MAP.items():
+            if state & value:
+                self.states.append(name)
 
     def __str__(self):
         if len(self.states) > 1:
@@ -127,20 +168,29 @@ class HSM_state:
 
 def hsm_state_from_flags(flags):
     state = 0
-    for flag_def in HSM_FLAGS:
-        for flag in flags:
-            if flag_def[0] == flag:
-                state += int(flag_def[1], 16)
+    for flag in flags:
+        state |= HSM_FLAG_MAP.get(flag, 0)
     return state
 
 
+def _encode(path):
+    """Returns path as bytes, paths already given as bytes are not copied."""
+    if isinstance(path, bytes):
+        return path
+    return os.fsencode(path)
+
+
 class hsm_copytool_private(ctypes.Structure):
     pass
 
 
 lov_user_md_v1_p = ctypes.POINTER(lov_user_md_v1)
 hsm_user_state_p = ctypes.POINTER(hsm_user_state)
+lu_fid_p = ctypes.POINTER(lu_fid)
+hsm_copytool_private_p = ctypes.POINTER(hsm_copytool_private)
 
+# With POINTER() argtypes, the hot paths pass structures directly and let
+# ctypes take their address, which is cheaper than building a byref().
 lustre.llapi_file_get_stripe.argtypes = [ctypes.c_char_p, lov_user_md_v1_p]
 lustre.llapi_file_open.argtypes = [ctypes.c_char_p, ctypes.c_int,
                                    ctypes.c_int, ctypes.c_ulong, ctypes.c_int,
@@ -148,6 +198,23 @@ lustre.llapi_file_open.argtypes = [ctypes.c_char_p, ctypes.c_int,
 lustre.llapi_hsm_state_get.argtypes = [ctypes.c_char_p, hsm_user_state_p]
 lustre.llapi_hsm_state_set.argtypes = [ctypes.c_char_p, ctypes.c_uint,
                                        ctypes.c_uint, ctypes.c_uint]
+lustre.llapi_path2fid.argtypes = [ctypes.c_char_p, lu_fid_p]
+lustre.llapi_fid2path.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                  ctypes.c_char_p, ctypes.c_int,
+                                  ctypes.POINTER(ctypes.c_longlong),
+                                  ctypes.POINTER(ctypes.c_int)]
+lustre.llapi_hsm_copytool_register.argtypes = [
+    hsm_copytool_private_p, ctypes.c_char_p, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+lustre.llapi_hsm_copytool_unregister.argtypes = [hsm_copytool_private_p]
+
+for func in (lustre.llapi_file_get_stripe, lustre.llapi_file_open,
+             lustre.llapi_hsm_state_get, lustre.llapi_hsm_state_set,
+             lustre.llapi_path2fid, lustre.llapi_fid2path,
+             lustre.llapi_hsm_copytool_register,
+             lustre.llapi_hsm_copytool_unregister):
+    func.restype = ctypes.c_int
+del func
 
 
 class stripeObj:
@@ -157,19 +224,32 @@ class stripeObj:
     This object contains details of the striping of a lustre file.
 
     Attributes:
-      lovdata:  lov_user_md_v1 structure as returned by the lustre C API.
+      lovdata:  lov_user_md_v1 structure as returned by the lustre C API,
+      trimmed to stripecount OST objects.
       stripecount: Stripe count.
       stripesize:  Stripe size (bytes).
       stripeoffset: Stripe offset.
       ostobjects[]: List of lov_user_ost_data_v1 structures as returned by the
       C API.
+      ost_idx: array of the OST index of each object.
+      object_id: array of the object id of each object.
+      ostobjects, ost_idx and object_id are built from lovdata on first
+      access.
+      striped: isstriped() as computed by getstripe, not updated if
+      stripecount is changed afterwards.
     """
+    __slots__ = ('lovdata', 'stripecount', 'stripesize', 'stripeoffset',
+                 'striped', '_ostobjects', '_ost_idx', '_object_id')
+
     def __init__(self):
-        self.lovdata = lov_user_md_v1()
+        self.lovdata = None
         self.stripecount = -1
         self.stripesize = 0
         self.stripeoffset = -1
-        self.ostobjects = []
+        self.striped = True
+        self._ostobjects = None
+        self._ost_idx = None
+        self._object_id = None
 
     def __str__(self):
         string = "Stripe Count: %i Stripe Size: %i Stripe Offset: %i\n" \
@@ -185,6 +265,61 @@ class stripeObj:
         else:
             return(False)
 
+    @property
+    def ostobjects(self):
+        if self._ostobjects is None:
+            if self.lovdata is None:
+                self._ostobjects = []
+            else:
+                self._ostobjects = self.lovdata.lmm_objects[:]
+        return self._ostobjects
+
+    @ostobjects.setter
+    def ostobjects(self, value):
+        self._ostobjects = value
+
+    @property
+    def ost_idx(self):
+        if self._ost_idx is None:
+            self._ost_idx = self._ost_column(lov_user_ost_data_v1.l_ost_idx,
+                                             'I')
+        return self._ost_idx
+
+    @property
+    def object_id(self):
+        if self._object_id is None:
+            self._object_id = self._ost_column(
+                lov_user_ost_data_v1.l_object_id, 'Q')
+        return self._object_id
+
+    def _ost_column(self, field, typecode):
+        """Returns one lov_user_ost_data_v1 field of every object as an
+        array, read straight from the raw bytes of lovdata.
+        """
+        column = array.array(typecode)
+        if self.lovdata is None:
+            return column
+        objects = self.lovdata.lmm_objects
+        column.frombytes(ctypes.string_at(ctypes.addressof(objects),
+                                          ctypes.sizeof(objects)))
+        step = ctypes.sizeof(lov_user_ost_data_v1) // column.itemsize
+        return column[field.offset // column.itemsize::step]
+
+_scratch = threading.local()
+
+
+def _lov_buffer():
+    """Returns this thread's reusable lov_user_md_v1 call buffer.
+
+    getstripe copies what it needs out of the buffer before returning, so a
+    single buffer per thread is enough.
+    """
+    try:
+        return _scratch.lovdata
+    except AttributeError:
+        _scratch.lovdata = lov_user_md_v1()
+        return _scratch.lovdata
+
 
 def getstripe(filename):
     """Returns a stripeObj containing the stipe information of filename.
@@ -196,9 +331,8 @@ def getstripe(filename):
       A stripeObj containing the stripe information.
     """
     stripeobj = stripeObj()
-    lovdata = lov_user_md_v1()
-    stripeobj.lovdata = lovdata
-    err = lustre.llapi_file_get_stripe(filename, ctypes.byref(lovdata))
+    lovdata = _lov_buffer()
+    err = lustre.llapi_file_get_stripe(_encode(filename), lovdata)
 
     # err 61 is due to  LU-541 (see below)
     if err < 0 and err != -61:
@@ -208,24 +342,98 @@ def getstripe(filename):
     # workaround for Whamcloud LU-541
     # use the filesystem defaults if no properties set
     if err == -61:
+        stripeobj.lovdata = _lov_user_md_v1_sized(0)()
         stripeobj.stripecount = 0
         stripeobj.stripesize = 0
         stripeobj.stripeoffset = -1
+        stripeobj.striped = False
 
     else:
-        for i in range(0, lovdata.lmm_stripe_count):
-            stripeobj.ostobjects.append(lovdata.lmm_objects[i])
-
-        stripeobj.stripecount = lovdata.lmm_stripe_count
-        stripeobj.stripesize = lovdata.lmm_stripe_size
-        # lmm_stripe_offset seems to be reported as 0, which is wrong
-        if len(stripeobj.ostobjects) > 0:
-            stripeobj.stripeoffset = stripeobj.ostobjects[0].l_ost_idx
-        else:
-            stripeobj.stripeoffset = -1
+        # Only keep the populated part of the 2000 OST buffer
+        count = max(lovdata.lmm_stripe_count, 0)
+        trimmed = _lov_user_md_v1_sized(count)()
+        ctypes.memmove(ctypes.byref(trimmed), ctypes.byref(lovdata),
+                       ctypes.sizeof(trimmed))
+        _fill_stripeobj(stripeobj, trimmed)
     return(stripeobj)
 
 
+def _fill_stripeobj(stripeobj, lovdata):
+    """Populates stripeobj from a _lov_user_md_v1_sized() structure."""
+    stripeobj.lovdata = lovdata
+    stripeobj.stripecount = lovdata.lmm_stripe_count
+    stripeobj.stripesize = lovdata.lmm_stripe_size
+    stripeobj.striped = (stripeobj.stripecount > 1 or
+                         stripeobj.stripecount == -1)
+    # lmm_stripe_offset seems to be reported as 0, which is wrong
+    if len(lovdata.lmm_objects) > 0:
+        stripeobj.stripeoffset = lovdata.lmm_objects[0].l_ost_idx
+    else:
+        stripeobj.stripeoffset = -1
+
+
+def getstripe_xattr(filename):
+    """Returns a stripeObj containing the stripe information of filename.
+
+    The layout is read from the lustre.lov extended attribute with a plain
+    getxattr() instead of going through liblustreapi. Layouts other than
+    LOV_MAGIC_V1 (v3 pools, composite layouts) and files without the
+    attribute are handed to getstripe(), other errors are raised directly.
+    Like llapi_file_get_stripe(), symlinks are not followed.
+
+    Arguments:
+      filename: The name of the file to query.
+
+    Returns:
+      A stripeObj containing the stripe information.
+    """
+    try:
+        data = os.getxattr(_encode(filename), "lustre.lov",
+                           follow_symlinks=False)
+    except OSError as e:
+        # No layout, or not a lustre file: let liblustreapi handle it
+        if e.errno in (errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP):
+            return getstripe(filename)
+        raise
+
+    header = _lov_user_md_v1_sized(0)
+    if len(data) < ctypes.sizeof(header):
+        return getstripe(filename)
+    lovdata = header.from_buffer_copy(data)
+    if lovdata.lmm_magic != LOV_MAGIC_V1:
+        return getstripe(filename)
+
+    layout = _lov_user_md_v1_sized(max(lovdata.lmm_stripe_count, 0))
+    if len(data) < ctypes.sizeof(layout):
+        return getstripe(filename)
+
+    stripeobj = stripeObj()
+    _fill_stripeobj(stripeobj, layout.from_buffer_copy(data))
+    return(stripeobj)
+
+
+def getstripe_parallel(filenames, max_workers=64, use_xattr=False):
+    """Returns a list of stripeObj, one for each entry of filenames.
+
+    The lookups are spread over a pool of threads. ctypes releases the GIL
+    while llapi_file_get_stripe() waits on the MDS, as does os.getxattr(),
+    so up to max_workers RPCs are in flight at once. As with getstripe(),
+    the first file that fails raises its IOError.
+
+    Arguments:
+      filenames: The names of the files to query.
+      max_workers: Number of threads.
+      use_xattr: Read each layout with getstripe_xattr() instead of
+      getstripe().
+
+    Returns:
+      A list of stripeObj in the same order as filenames.
+    """
+    func = getstripe_xattr if use_xattr else getstripe
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(func, filenames))
+
+
 def setstripe(filename, stripeobj=None, stripesize=0, stripeoffset=-1,
               stripecount=1):
     """Sets the striping on an existing directory, or create a new empty file
@@ -255,7 +463,7 @@ def setstripe(filename, stripeobj=None, stripesize=0, stripeoffset=-1,
 
     """
     flags = os.O_CREAT
-    mode = '0700'
+    mode = 0o700
     # only stripe_pattern 0 is supported by lustre.
     stripe_pattern = 0
 
@@ -269,7 +477,7 @@ def setstripe(filename, stripeobj=None, stripesize=0, stripeoffset=-1,
 
     message = captureStderr()
 
-    fd = lustre.llapi_file_open(filename, flags, mode, stripesize,
+    fd = lustre.llapi_file_open(_encode(filename), flags, mode, stripesize,
                                 stripeoffset, stripecount, stripe_pattern)
     message.readData()
     message.stopCapture()
@@ -285,8 +493,8 @@ def setstripe(filename, stripeobj=None, stripesize=0, stripeoffset=-1,
 def path2fid(filename):
     lufid = lu_fid()
     err = lustre.llapi_path2fid(
-        filename.encode('utf8'),
-        ctypes.byref(lufid))
+        _encode(filename),
+        lufid)
     if err < 0:
         err = 0 - err
         raise IOError(err, os.strerror(err))
@@ -300,7 +508,7 @@ def fid2path(device, fid):
     recno = ctypes.c_longlong()
     linkno = ctypes.c_int()
     err = lustre.llapi_fid2path(
-        device.encode(),
+        _encode(device),
         fid.encode(),
         path,
         pathlen,
@@ -310,14 +518,14 @@ def fid2path(device, fid):
     if err < 0:
         err = 0 - err
         raise IOError(err, os.strerror(err))
-    return device + "/" + path.value.decode()
+    return os.fsdecode(device) + "/" + os.fsdecode(path.value)
 
 
 def get_hsm_state(filename):
     hus = hsm_user_state()
     err = lustre.llapi_hsm_state_get(
-        filename.encode('utf8'),
-        ctypes.byref(hus))
+        _encode(filename),
+        hus)
     if err < 0:
         err = 0 - err
         raise IOError(err, os.strerror(err))
@@ -325,11 +533,14 @@ def get_hsm_state(filename):
 
 
 def set_hsm_state(filename, setmask, clearmask, archive_id):
-    print(filename, hsm_state_from_flags(setmask), hsm_state_from_flags(clearmask), archive_id)
+    setflags = hsm_state_from_flags(setmask)
+    clearflags = hsm_state_from_flags(clearmask)
+    logger.debug("set_hsm_state %s set=%#x clear=%#x archive=%d",
+                 filename, setflags, clearflags, archive_id)
     err = lustre.llapi_hsm_state_set(
-        filename.encode('utf8'),
-        hsm_state_from_flags(setmask),
-        hsm_state_from_flags(clearmask),
+        _encode(filename),
+        setflags,
+        clearflags,
         archive_id)
     if err < 0:
         err = 0 - err
@@ -347,12 +558,9 @@ class hsm_agent():
     def hsm_copytool_register(self, mnt, archives=[1], rfd_flags=0):
         archives_arr = (ctypes.c_int * len(archives))(*archives)
         archives_p = ctypes.POINTER(ctypes.c_int)
-        lustre.llapi_hsm_copytool_register.argtypes = [
-            ctypes.POINTER(hsm_copytool_private), ctypes.c_char_p,
-            ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int]
         err = lustre.llapi_hsm_copytool_register(
             ctypes.byref(self.hsm_copytool_private),
-            mnt,
+            _encode(mnt),
             len(archives),
             archives_arr,
             rfd_flags)
@@ -361,8 +569,6 @@ class hsm_agent():
             raise IOError(err, os.strerror(err))
 
     def hsm_copytool_unregister(self):
-        lustre.llapi_hsm_copytool_unregister.argtypes = [
-            ctypes.POINTER(hsm_copytool_private)]
         err = lustre.llapi_hsm_copytool_unregister(
             ctypes.byref(self.hsm_copytool_private))
         if err < 0:
@@ -372,8 +578,15 @@ class hsm_agent():
 
 class captureStderr():
     """This class intercepts stderr and stores any output"""
+    # The pipe is created on first use and shared by every capture, only
+    # stderr itself is swapped in and out around each call.
+    pipeout = None
+    pipein = None
+
     def __init__(self):
-        self.pipeout, self.pipein = os.pipe()
+        if captureStderr.pipeout is None:
+            captureStderr.pipeout, captureStderr.pipein = os.pipe()
+            os.set_blocking(captureStderr.pipeout, False)
         self.oldstderr = os.dup(2)
         os.dup2(self.pipein, 2)
         self.contents = ""
@@ -383,16 +596,18 @@ class captureStderr():
 
     def readData(self):
         """Read data from stderr until there is no more."""
-        while self.checkData():
-            self.contents += os.read(self.pipeout, 1024)
-
-    def checkData(self):
-        """Check to see if there is any data to be read."""
-        r, _, _ = select.select([self.pipeout], [], [], 0)
-        return bool(r)
+        data = bytearray()
+        while True:
+            try:
+                chunk = os.read(self.pipeout, 4096)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        self.contents += data.decode('utf8', 'replace')
 
     def stopCapture(self):
         """Restore the original stderr"""
         os.dup2(self.oldstderr, 2)
-        os.close(self.pipeout)
-        os.close(self.pipein)
+        os.close(self.oldstderr)
@@ -0,0 +1,139 @@
+import errno
+import struct
+import unittest
+from unittest import mock
+
+try:
+    import lustreapi
+except OSError:
+    # lustreapi loads liblustreapi.so at import time
+    lustreapi = None
+
+
+def lov_v1_bytes(objects, magic=0x0bd10bd0, stripe_size=1048576):
+    """Returns a lov_user_md_v1 as raw bytes, objects is a list of
+    (object_id, ost_idx) tuples.
+    """
+    data = struct.pack('=IIQQIhh', magic, 1, 5, 0, stripe_size,
+                       len(objects), 0)
+    for object_id, ost_idx in objects:
+        data += struct.pack('=QQII', object_id, 0, 0, ost_idx)
+    return data
+
+
+@unittest.skipIf(lustreapi is None, "liblustreapi.so is not available")
+class StripeObjTest(unittest.TestCase):
+    objects = [(77, 3), (78, 8), (2 ** 40, 65535)]
+
+    def stripeobj(self):
+        layout = lustreapi._lov_user_md_v1_sized(len(self.objects))
+        stripeobj = lustreapi.stripeObj()
+        lustreapi._fill_stripeobj(
+            stripeobj, layout.from_buffer_copy(lov_v1_bytes(self.objects)))
+        return stripeobj
+
+    def test_fields(self):
+        stripeobj = self.stripeobj()
+        self.assertEqual(stripeobj.stripecount, 3)
+        self.assertEqual(stripeobj.stripesize, 1048576)
+        self.assertEqual(stripeobj.stripeoffset, 3)
+        self.assertTrue(stripeobj.striped)
+
+    def test_arrays_match_ostobjects(self):
+        stripeobj = self.stripeobj()
+        self.assertEqual(list(stripeobj.ost_idx),
+                         [ost.l_ost_idx for ost in stripeobj.ostobjects])
+        self.assertEqual(list(stripeobj.object_id),
+                         [ost.l_object_id for ost in stripeobj.ostobjects])
+        self.assertEqual(list(stripeobj.ost_idx), [3, 8, 65535])
+        self.assertEqual(list(stripeobj.object_id), [77, 78, 2 ** 40])
+
+    def test_ostobjects_is_cached(self):
+        stripeobj = self.stripeobj()
+        self.assertIs(stripeobj.ostobjects, stripeobj.ostobjects)
+        self.assertIs(stripeobj.ost_idx, stripeobj.ost_idx)
+        self.assertIs(stripeobj.object_id, stripeobj.object_id)
+
+    def test_isstriped_follows_stripecount(self):
+        stripeobj = lustreapi.stripeObj()
+        stripeobj.stripecount = 1
+        self.assertFalse(stripeobj.isstriped())
+        stripeobj.stripecount = 4
+        self.assertTrue(stripeobj.isstriped())
+
+    def test_empty(self):
+        stripeobj = lustreapi.stripeObj()
+        self.assertEqual(stripeobj.ostobjects, [])
+        self.assertEqual(len(stripeobj.ost_idx), 0)
+        self.assertEqual(len(stripeobj.object_id), 0)
+
+
+@unittest.skipIf(lustreapi is None, "liblustreapi.so is not available")
+class FidTest(unittest.TestCase):
+    def test_str(self):
+        self.assertEqual(str(lustreapi.Fid(0x200000401, 1, 0)),
+                         "[0x200000401:0x1:0x0]")
+
+    def test_str_after_assignment(self):
+        fid = lustreapi.Fid(0x200000401, 1, 0)
+        str(fid)
+        fid.oid = 0x2a
+        self.assertEqual(str(fid), "[0x200000401:0x2a:0x0]")
+
+
+@unittest.skipIf(lustreapi is None, "liblustreapi.so is not available")
+class GetstripeXattrTest(unittest.TestCase):
+    def getstripe_xattr(self, data=None, error=None):
+        """Runs getstripe_xattr() on a fake lustre.lov, returns the result
+        and whether it fell back to getstripe().
+        """
+        getxattr = mock.Mock(return_value=data, side_effect=error)
+        fallback = lustreapi.stripeObj()
+        with mock.patch('lustreapi.os.getxattr', getxattr), \
+                mock.patch('lustreapi.getstripe',
+                           return_value=fallback) as getstripe:
+            result = lustreapi.getstripe_xattr('/lustre/file')
+        getxattr.assert_called_once_with(b'/lustre/file', 'lustre.lov',
+                                         follow_symlinks=False)
+        return result, getstripe.called and result is fallback
+
+    def test_v1_layout(self):
+        result, fell_back = self.getstripe_xattr(
+            lov_v1_bytes([(77, 3), (78, 8)], stripe_size=4194304))
+        self.assertFalse(fell_back)
+        self.assertEqual(result.stripecount, 2)
+        self.assertEqual(result.stripesize, 4194304)
+        self.assertEqual(result.stripeoffset, 3)
+        self.assertEqual(list(result.ost_idx), [3, 8])
+        self.assertEqual(list(result.object_id), [77, 78])
+
+    def test_short_header(self):
+        _, fell_back = self.getstripe_xattr(lov_v1_bytes([])[:20])
+        self.assertTrue(fell_back)
+
+    def test_short_objects(self):
+        _, fell_back = self.getstripe_xattr(
+            lov_v1_bytes([(77, 3), (78, 8)])[:-4])
+        self.assertTrue(fell_back)
+
+    def test_other_magic(self):
+        _, fell_back = self.getstripe_xattr(
+            lov_v1_bytes([(77, 3)], magic=0x0bd30bd0))
+        self.assertTrue(fell_back)
+
+    def test_no_layout(self):
+        for err in (errno.ENODATA, errno.ENOTSUP):
+            _, fell_back = self.getstripe_xattr(
+                error=OSError(err, "error"))
+            self.assertTrue(fell_back)
+
+    def test_other_errors_raise(self):
+        getxattr = mock.Mock(side_effect=OSError(errno.ENOENT, "No file"))
+        with mock.patch('lustreapi.os.getxattr', getxattr), \
+                mock.patch('lustreapi.getstripe') as getstripe:
+            with self.assertRaises(FileNotFoundError):
+                lustreapi.getstripe_xattr('/lustre/file')
+        getstripe.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()